@@ -1,9 +1,11 @@
+import functools
 import typing as t
 from io import BytesIO
 from pathlib import Path
 
 import discord
-from PIL import Image, ImageDraw, ImageOps
+import numpy as np
+from PIL import Image, ImageDraw
 
 from bot.constants import Colours
 
@@ -13,73 +15,123 @@ class PfpEffects:
     Implements various image modifying effects, for the PfpModify cog.
 
     All of these fuctions are slow, and blocking, so they should be ran in executors.
+
+    Effects should be built from whole image Pillow operations (resize, convert, paste, point...) or
+    NumPy array operations. These do their work in C and largely release the GIL while doing so, which
+    lets the executor's threads run several effects in parallel. Per-pixel Python, like getpixel,
+    putpixel or looping over getdata, holds the GIL for the whole effect and serialises them instead.
     """
 
     @staticmethod
-    def apply_effect(image_bytes: bytes, effect: t.Callable, filename: str, *args) -> discord.File:
+    def apply_effect(image_bytes: t.Union[bytes, bytearray], effect: t.Callable, filename: str, *args) -> discord.File:
         """Applies the given effect to the image passed to it."""
         im = Image.open(BytesIO(image_bytes))
         im = im.convert("RGBA")
         im = effect(im, *args)
 
         bufferedio = BytesIO()
-        im.save(bufferedio, format="PNG")
+        if im.mode == "P":
+            # Flat palette images (the 8bit effect) are both smaller and exact when saved losslessly
+            im.save(bufferedio, format="WEBP", lossless=True)
+        else:
+            im.save(bufferedio, format="WEBP", quality=90, method=2)
         bufferedio.seek(0)
 
         return discord.File(bufferedio, filename=filename)
 
     @staticmethod
-    def closest(x: t.Tuple[int, int, int]) -> t.Tuple[int, int, int]:
+    @functools.lru_cache(maxsize=1)
+    def get_easter_lut() -> np.ndarray:
+        """
+        Builds a lookup table of the "easterified" version of every colour.
+
+        Colours are posterized to 6 bits per channel first, so the table is indexed by `[r >> 2, g >> 2, b >> 2]`.
+        Each entry is a merge between that colour and the closest "easter" colour to it.
         """
-        Finds the closest "easter" colour to a given pixel.
+        values = np.arange(0, 256, 4, dtype=np.int32)
+        colours = np.stack(np.meshgrid(values, values, values, indexing="ij"), axis=-1)
 
-        Returns a merge between the original colour and the closest colour.
+        closest = np.empty_like(colours)
+        closest_distance = np.full(colours.shape[:-1], np.iinfo(np.int32).max)
+        for easter_colour in Colours.easter_like_colours:
+            distance = ((colours - easter_colour) ** 2).sum(axis=-1)
+            # Strictly closer only, so ties go to the first colour in the list
+            is_closer = distance < closest_distance
+            closest[is_closer] = easter_colour
+            closest_distance[is_closer] = distance[is_closer]
+
+        return ((colours + closest) // 2).astype(np.uint8)
+
+    @staticmethod
+    @functools.lru_cache()
+    def get_circle_mask(size: t.Tuple[int, int]) -> Image:
         """
-        r1, g1, b1 = x
+        Returns a mask of a circle filling an image of the given size.
 
-        def distance(point: t.Tuple[int, int, int]) -> t.Tuple[int, int, int]:
-            """Finds the difference between a pastel colour and the original pixel colour."""
-            r2, g2, b2 = point
-            return (r1 - r2) ** 2 + (g1 - g2) ** 2 + (b1 - b2) ** 2
+        The result is cached, so it must not be modified in place by the caller.
+        """
+        mask = Image.new("L", size, 0)
+        draw = ImageDraw.Draw(mask)
+        draw.ellipse((0, 0) + size, fill=255)
+        return mask
 
-        closest_colours = sorted(Colours.easter_like_colours, key=distance)
-        r2, g2, b2 = closest_colours[0]
-        r = (r1 + r2) // 2
-        g = (g1 + g2) // 2
-        b = (b1 + b2) // 2
+    @staticmethod
+    @functools.lru_cache(maxsize=16)
+    def get_ring_mask(px: int) -> Image:
+        """
+        Returns a mask of a ring `px` pixels thick around the edge of a 1024x1024 image.
 
-        return r, g, b
+        The result is cached, so it must not be modified in place by the caller.
+        """
+        mask = PfpEffects.get_circle_mask((1024, 1024)).copy()
+        draw = ImageDraw.Draw(mask)
+        draw.ellipse((px, px, 1024-px, 1024-px), fill=0)
+        return mask
 
     @staticmethod
     def crop_avatar_circle(avatar: Image) -> Image:
         """This crops the avatar given into a circle."""
-        mask = Image.new("L", avatar.size, 0)
-        draw = ImageDraw.Draw(mask)
-        draw.ellipse((0, 0) + avatar.size, fill=255)
-        avatar.putalpha(mask)
+        avatar.putalpha(PfpEffects.get_circle_mask(avatar.size))
         return avatar
 
     @staticmethod
-    def crop_ring(ring: Image, px: int) -> Image:
-        """This crops the given ring into a circle."""
-        mask = Image.new("L", ring.size, 0)
-        draw = ImageDraw.Draw(mask)
-        draw.ellipse((0, 0) + ring.size, fill=255)
-        draw.ellipse((px, px, 1024-px, 1024-px), fill=0)
-        ring.putalpha(mask)
-        return ring
+    @functools.lru_cache(maxsize=8)
+    def get_flag(flag: str) -> Image:
+        """
+        Opens and decodes the given pride flag, at its original size and mode.
+
+        The result is cached, so it must not be modified in place by the caller.
+        """
+        with Image.open(Path(f"bot/resources/pride/flags/{flag}.png")) as flag_image:
+            return flag_image.copy()
 
     @staticmethod
-    def pridify_effect(image: Image, pixels: int, flag: str) -> Image:
-        """Applies the given pride effect to the given image."""
-        image = image.resize((1024, 1024))
+    @functools.lru_cache(maxsize=1)
+    def get_chocolate_bunny() -> Image:
+        """
+        Opens and decodes the default easterify overlay, a chocolate bunny.
+
+        The result is cached, so it must not be modified in place by the caller.
+        """
+        return Image.open(Path("bot/resources/easter/chocolate_bunny.png")).convert("RGBA")
+
+    @staticmethod
+    def pridify_effect(image: Image, pixels: int, flag: Image) -> Image:
+        """
+        Applies the given pride effect to the given image.
+
+        Large images (from the image subcommand) are first shrunk with a cheap reduce before the
+        final resample, which is much faster than resampling the full image down to 1024x1024.
+        """
+        image = image.resize((1024, 1024), reducing_gap=3.0)
         image = PfpEffects.crop_avatar_circle(image)
 
-        ring = Image.open(Path(f"bot/resources/pride/flags/{flag}.png")).resize((1024, 1024))
-        ring = ring.convert("RGBA")
-        ring = PfpEffects.crop_ring(ring, pixels)
+        # Resize before converting, so palette flags keep their nearest-neighbour resampling.
+        # Going through RGB drops any transparency, as the flag is always drawn fully opaque.
+        flag = flag.resize((1024, 1024)).convert("RGB")
 
-        image.alpha_composite(ring, (0, 0))
+        # Both the flag and the ring mask are fully opaque, so a masked paste is enough, no blending is needed
+        image.paste(flag, (0, 0), PfpEffects.get_ring_mask(pixels))
         return image
 
     @staticmethod
@@ -87,12 +139,12 @@ class PfpEffects:
         """
         Applies the 8bit effect to the given image.
 
-        This is done by reducing the image to 32x32 and then back up to 1024x1024.
-        We then quantize the image before returning too.
+        This is done by reducing the image to 32x32, quantizing it and then scaling it back up to 1024x1024.
+        Quantizing before scaling up means only the 32x32 pixels need to be palettised.
         """
         image = image.resize((32, 32), resample=Image.NEAREST)
-        image = image.resize((1024, 1024), resample=Image.NEAREST)
-        return image.quantize()
+        image = image.quantize()
+        return image.resize((1024, 1024), resample=Image.NEAREST)
 
     @staticmethod
     def easterify_effect(image: Image, overlay_image: Image = None) -> Image:
@@ -112,26 +164,16 @@ class PfpEffects:
             ))
             overlay_image = overlay_image.convert("RGBA")
         else:
-            overlay_image = Image.open(Path("bot/resources/easter/chocolate_bunny.png"))
-
-        alpha = image.getchannel("A").getdata()
-        image = image.convert("RGB")
-        image = ImageOps.posterize(image, 6)
-
-        data = image.getdata()
-        data_set = set(data)
-        easterified_data_set = {}
-
-        for x in data_set:
-            easterified_data_set[x] = PfpEffects.closest(x)
-        new_pixel_data = [
-            (*easterified_data_set[x], alpha[i])
-            if x in easterified_data_set else x
-            for i, x in enumerate(data)
-        ]
-
-        im = Image.new("RGBA", image.size)
-        im.putdata(new_pixel_data)
+            overlay_image = PfpEffects.get_chocolate_bunny()
+
+        pixels = np.asarray(image)
+        lut = PfpEffects.get_easter_lut()
+
+        easterified = np.empty_like(pixels)
+        easterified[..., :3] = lut[pixels[..., 0] >> 2, pixels[..., 1] >> 2, pixels[..., 2] >> 2]
+        easterified[..., 3] = pixels[..., 3]
+
+        im = Image.fromarray(easterified)
         im.alpha_composite(
             overlay_image,
             (im.width - overlay_image.width, (im.height - overlay_image.height) // 2)
@@ -4,12 +4,14 @@ import logging
 import string
 import typing as t
 import unicodedata
+import weakref
 from concurrent.futures import ThreadPoolExecutor
 
 import discord
-from aiohttp import client_exceptions
+from aiohttp import ClientResponse, client_exceptions
 from discord.ext import commands
 from discord.ext.commands.errors import BadArgument
+from PIL import Image
 
 from bot.constants import Client, Colours, Emojis
 from bot.exts.evergreen.avatar_modification._effects import PfpEffects
@@ -20,7 +22,17 @@ log = logging.getLogger(__name__)
 
 _EXECUTOR = ThreadPoolExecutor(10)
 
-FILENAME_STRING = "{effect}_{author}.png"
+# Locks limiting each user to one effect in the executor at a time, only kept around while in use
+_USER_LOCKS = weakref.WeakValueDictionary()
+
+FILENAME_STRING = "{effect}_{author}.webp"
+
+VALID_FILENAME_CHARS = f"-_. {string.ascii_letters}{string.digits}"
+# Every byte outside of VALID_FILENAME_CHARS, so they can be stripped with a single `bytes.translate` call
+INVALID_FILENAME_BYTES = bytes(i for i in range(256) if chr(i) not in VALID_FILENAME_CHARS)
+
+# The largest image that will be downloaded from a user provided URL, in bytes
+MAX_IMAGE_SIZE = 10 * 1024 * 1024
 
 with open("bot/resources/pride/gender_options.json") as f:
     GENDER_OPTIONS = json.load(f)
@@ -38,21 +50,57 @@ async def in_executor(func: t.Callable, *args) -> t.Any:
     return await loop.run_in_executor(_EXECUTOR, func, *args)
 
 
+async def read_response(response: ClientResponse) -> t.Optional[bytearray]:
+    """
+    Reads the whole body of the given response into a single buffer.
+
+    When the response has a Content-Length header the buffer is allocated up front, so it doesn't
+    have to be regrown or joined from a list of chunks as the body is streamed in.
+
+    Returns None if the body is larger than `MAX_IMAGE_SIZE`, without reading any more of it.
+    """
+    if (response.content_length or 0) > MAX_IMAGE_SIZE:
+        return None
+
+    buffer = bytearray(response.content_length or 0)
+    size = 0
+    async for chunk in response.content.iter_chunked(65536):
+        if size + len(chunk) > MAX_IMAGE_SIZE:
+            return None
+
+        # Slice assignment grows the buffer if the body is larger than advertised (e.g. when compressed)
+        buffer[size:size + len(chunk)] = chunk
+        size += len(chunk)
+
+    del buffer[size:]
+    return buffer
+
+
+def user_lock(user_id: int) -> asyncio.Lock:
+    """
+    Returns the lock for running avatar effects on behalf of the given user.
+
+    Holding it around executor calls stops a single user from taking up every thread of the executor.
+    """
+    lock = _USER_LOCKS.get(user_id)
+    if lock is None:
+        lock = _USER_LOCKS[user_id] = asyncio.Lock()
+    return lock
+
+
 def file_safe_name(effect: str, display_name: str) -> str:
     """Returns a file safe filename based on the given effect and display name."""
-    valid_filename_chars = f"-_. {string.ascii_letters}{string.digits}"
-
     file_name = FILENAME_STRING.format(effect=effect, author=display_name)
 
     # Replace spaces
     file_name = file_name.replace(" ", "_")
 
     # Normalize unicode characters
-    cleaned_filename = unicodedata.normalize("NFKD", file_name).encode("ASCII", "ignore").decode()
+    cleaned_filename = unicodedata.normalize("NFKD", file_name).encode("ASCII", "ignore")
 
     # Remove invalid filename characters
-    cleaned_filename = "".join(c for c in cleaned_filename if c in valid_filename_chars)
-    return cleaned_filename
+    cleaned_filename = cleaned_filename.translate(None, INVALID_FILENAME_BYTES)
+    return cleaned_filename.decode()
 
 
 class AvatarModify(commands.Cog):
@@ -94,15 +142,16 @@ class AvatarModify(commands.Cog):
                 await ctx.send(f"{Emojis.cross_mark} Could not get member info.")
                 return
 
-            image_bytes = await member.avatar_url.read()
+            image_bytes = await member.avatar_url_as(size=128).read()
             file_name = file_safe_name("eightbit_avatar", member.display_name)
 
-            file = await in_executor(
-                PfpEffects.apply_effect,
-                image_bytes,
-                PfpEffects.eight_bitify_effect,
-                file_name
-            )
+            async with user_lock(ctx.author.id):
+                file = await in_executor(
+                    PfpEffects.apply_effect,
+                    image_bytes,
+                    PfpEffects.eight_bitify_effect,
+                    file_name
+                )
 
             embed = discord.Embed(
                 title="Your 8-bit avatar",
@@ -153,13 +202,14 @@ class AvatarModify(commands.Cog):
             image_bytes = await member.avatar_url_as(size=256).read()
             file_name = file_safe_name("easterified_avatar", member.display_name)
 
-            file = await in_executor(
-                PfpEffects.apply_effect,
-                image_bytes,
-                PfpEffects.easterify_effect,
-                file_name,
-                egg
-            )
+            async with user_lock(ctx.author.id):
+                file = await in_executor(
+                    PfpEffects.apply_effect,
+                    image_bytes,
+                    PfpEffects.easterify_effect,
+                    file_name,
+                    egg
+                )
 
             embed = discord.Embed(
                 name="Your Lovely Easterified Avatar!",
@@ -173,23 +223,24 @@ class AvatarModify(commands.Cog):
     @staticmethod
     async def send_pride_image(
         ctx: commands.Context,
-        image_bytes: bytes,
+        image_bytes: t.Union[bytes, bytearray],
         pixels: int,
-        flag: str,
+        flag: Image.Image,
         option: str
     ) -> None:
         """Gets and sends the image in an embed. Used by the pride commands."""
         async with ctx.typing():
             file_name = file_safe_name("pride_avatar", ctx.author.display_name)
 
-            file = await in_executor(
-                PfpEffects.apply_effect,
-                image_bytes,
-                PfpEffects.pridify_effect,
-                file_name,
-                pixels,
-                flag
-            )
+            async with user_lock(ctx.author.id):
+                file = await in_executor(
+                    PfpEffects.apply_effect,
+                    image_bytes,
+                    PfpEffects.pridify_effect,
+                    file_name,
+                    pixels,
+                    flag
+                )
 
             embed = discord.Embed(
                 name="Your Lovely Pride Avatar!",
@@ -225,8 +276,12 @@ class AvatarModify(commands.Cog):
             if not member:
                 await ctx.send(f"{Emojis.cross_mark} Could not get member info.")
                 return
-            image_bytes = await member.avatar_url_as(size=1024).read()
-            await self.send_pride_image(ctx, image_bytes, pixels, flag, option)
+            # The avatar download and the flag decode are independent, so run them concurrently.
+            image_bytes, flag_image = await asyncio.gather(
+                member.avatar_url_as(size=1024).read(),
+                in_executor(PfpEffects.get_flag, flag)
+            )
+            await self.send_pride_image(ctx, image_bytes, pixels, flag_image, option)
 
     @prideavatar.command()
     async def image(self, ctx: commands.Context, url: str, option: str = "lgbt", pixels: int = 64) -> None:
@@ -251,13 +306,20 @@ class AvatarModify(commands.Cog):
                     if response.status != 200:
                         await ctx.send("Bad response from provided URL!")
                         return
-                    image_bytes = await response.read()
+                    if not response.content_type.startswith("image/"):
+                        await ctx.send("The provided URL isn't an image!")
+                        return
+                    image_bytes = await read_response(response)
+                    if image_bytes is None:
+                        await ctx.send(f"That image is too large! The limit is {MAX_IMAGE_SIZE // 1024 ** 2}MB.")
+                        return
             except client_exceptions.ClientConnectorError:
                 raise BadArgument("Cannot connect to provided URL!")
             except client_exceptions.InvalidURL:
                 raise BadArgument("Invalid URL!")
 
-            await self.send_pride_image(ctx, image_bytes, pixels, flag, option)
+            flag_image = await in_executor(PfpEffects.get_flag, flag)
+            await self.send_pride_image(ctx, image_bytes, pixels, flag_image, option)
 
     @prideavatar.command()
     async def flags(self, ctx: commands.Context) -> None:
@@ -287,16 +349,17 @@ class AvatarModify(commands.Cog):
             return
 
         async with ctx.typing():
-            image_bytes = await member.avatar_url.read()
+            image_bytes = await member.avatar_url_as(size=512).read()
 
             file_name = file_safe_name("spooky_avatar", member.display_name)
 
-            file = await in_executor(
-                PfpEffects.apply_effect,
-                image_bytes,
-                spookifications.get_random_effect,
-                file_name
-            )
+            async with user_lock(ctx.author.id):
+                file = await in_executor(
+                    PfpEffects.apply_effect,
+                    image_bytes,
+                    spookifications.get_random_effect,
+                    file_name
+                )
 
             embed = discord.Embed(
                 title="Is this you or am I just really paranoid?",
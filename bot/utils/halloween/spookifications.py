@@ -1,5 +1,7 @@
 import logging
+from functools import lru_cache
 from random import choice, randint
+from typing import Tuple
 
 from PIL import Image
 from PIL import ImageOps
@@ -7,6 +9,22 @@ from PIL import ImageOps
 log = logging.getLogger()
 
 
+@lru_cache(maxsize=None)
+def load_overlay(path: str) -> Image:
+    """
+    Opens and decodes one of the spooky overlay images.
+
+    The result is cached, so it must not be modified in place by the caller.
+    """
+    return Image.open(path).convert('RGBA')
+
+
+@lru_cache(maxsize=8)
+def sized_pentagram(size: Tuple[int, int]) -> Image:
+    """Returns the pentagram overlay resized to the given size, caching it for images of the same size."""
+    return load_overlay('bot/resources/halloween/bloody-pentagram.png').resize(size)
+
+
 def inversion(im: Image) -> Image:
     """
     Inverts the image.
@@ -21,9 +39,7 @@ def inversion(im: Image) -> Image:
 def pentagram(im: Image) -> Image:
     """Adds pentagram to the image."""
     im = im.convert('RGB')
-    wt, ht = im.size
-    penta = Image.open('bot/resources/halloween/bloody-pentagram.png')
-    penta = penta.resize((wt, ht))
+    penta = sized_pentagram(im.size)
     im.paste(penta, (0, 0), penta)
     return im
 
@@ -37,7 +53,7 @@ def bat(im: Image) -> Image:
     """
     im = im.convert('RGB')
     wt, ht = im.size
-    bat = Image.open('bot/resources/halloween/bat-clipart.png')
+    bat = load_overlay('bot/resources/halloween/bat-clipart.png')
     bat_size = randint(wt//10, wt//7)
     rot = randint(0, 90)
     bat = bat.resize((bat_size, bat_size))